@@ -7,9 +7,9 @@
     Inputs
         - html: https://evaluation-registry.cabinetoffice.gov.uk/search/?search_term=
     Outputs
-        - pkl: url_20250703.pkl
+        - parquet: urls_20250703.parquet
             - URLs for individual evaluations
-        - pkl: evaluationdetails_20250703.pkl
+        - parquet: evaluationdetails_20250703.parquet
             - Details of evaluations
     Notes
         - Using the Evaluation Registry search function without a search term results
@@ -20,60 +20,242 @@
 
 # flake8: noqa
 
+import asyncio
+from collections.abc import Coroutine
 import datetime
-import re
+import shelve
+import threading
+from typing import Any
+from urllib.parse import urlsplit, urlunsplit
 
 from bs4 import BeautifulSoup as bs
+import httpx
 from IPython.display import display     # noqa: E402
+from lxml import etree
+from lxml import html as lh
 import pandas as pd
-import requests
-from requests.adapters import HTTPAdapter, Retry
 
 # %%
 # SET UP REQUESTS
-session = requests.Session()
-retry = Retry(connect=5, backoff_factor=0.5)
-adapter = HTTPAdapter(max_retries=retry)
-session.mount("https://", adapter)
+headers = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"     # noqa: E501
+}
+
+# NB: Maximum number of requests in flight at once, also used as the maximum
+# number of connections. Over HTTP/2 many requests share one connection, so the
+# connection limit alone doesn't cap requests - request_semaphore does
+max_connections = 20
+request_semaphore = asyncio.Semaphore(max_connections)
+
+# NB: Requests are multiplexed over HTTP/2 where the server supports it. No
+# pool timeout, as most requests wait for a free connection when all pages
+# are requested at once
+transport = httpx.AsyncHTTPTransport(
+    http2=True,
+    retries=5,
+    limits=httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=10,
+    ),
+)
+client = httpx.AsyncClient(
+    transport=transport,
+    headers=headers,
+    timeout=httpx.Timeout(30.0, pool=None),
+)
+
+# NB: A single event loop and HTTP client are used for all requests, so that
+# connections are reused between search result pages and evaluation pages. The
+# loop runs in a worker thread so that cells can also be run interactively
+# (e.g. Jupyter, VS Code), where an event loop is already running
+loop = asyncio.new_event_loop()
+loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+loop_thread.start()
+
+
+def run(
+    coroutine: Coroutine[Any, Any, Any]
+) -> Any:
+    """Run a coroutine on the worker thread's event loop and wait for the result"""
+
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+# %%
+# SET UP OUTPUTS
+date_tag = "20250703"
+
+# %%
+# SET UP CACHE
+# NB: Pages are cached on disk so that re-runs only download pages that have
+# changed. Cached pages younger than cache_expire_after are used as-is, older
+# ones are revalidated with the server using their ETag/Last-Modified headers
+cache_expire_after = datetime.timedelta(days=1)
+
+
+async def cached(
+    coroutine: Coroutine[Any, Any, Any]
+) -> Any:
+    """Run a coroutine with the page cache open, closing the cache afterwards"""
+
+    # NB: The cache is opened, used and closed on the worker thread's event
+    # loop, as some dbm backends - e.g. dbm.sqlite3, the default from Python
+    # 3.13 - can only be used from the thread that opened them. It is closed
+    # even if fetching fails, as some backends only save changes on close
+    global cache
+    cache = shelve.open("evaluation_registry_cache")
+    try:
+        return await coroutine
+    finally:
+        cache.close()
+
+
+def get_cached(
+    url: str
+) -> tuple[str | None, dict[str, str]]:
+    """Grab page text from the cache, or headers to revalidate it if stale"""
+
+    cached = cache.get(url)
+    if cached is None:
+        return None, {}
+
+    if datetime.datetime.now() - cached["fetched"] < cache_expire_after:
+        return cached["text"], {}
+
+    revalidation_headers = {}
+    if cached["etag"]:
+        revalidation_headers["If-None-Match"] = cached["etag"]
+    if cached["last_modified"]:
+        revalidation_headers["If-Modified-Since"] = cached["last_modified"]
+
+    return None, revalidation_headers
+
+
+def set_cached(
+    url: str,
+    status: int,
+    response_headers: dict[str, str],
+    text: str
+) -> str:
+    """Save page text to the cache, returning the cached text if unchanged"""
+
+    if status == 304:
+        cached = cache[url]
+        cached["fetched"] = datetime.datetime.now()
+        cache[url] = cached
+        return cached["text"]
+
+    # NB: Only successful responses are cached, so e.g. "Page not found" pages
+    # are requested again on the next run
+    if status == 200:
+        cache[url] = {
+            "text": text,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "fetched": datetime.datetime.now(),
+        }
+
+    return text
+
+
+# NB: Responses retried with exponential backoff, e.g. when rate limited
+retry_statuses = (429, 500, 502, 503, 504)
+max_retries = 5
+backoff_factor = 0.5
+
+
+async def get_text(
+    client: httpx.AsyncClient,
+    url: str
+) -> str:
+    """Grab page text, using the cache where possible"""
+
+    text, revalidation_headers = get_cached(url)
+    if text is not None:
+        return text
+
+    for attempt in range(max_retries + 1):
+        async with request_semaphore:
+            req = await client.get(url, headers=revalidation_headers)
+        if req.status_code not in retry_statuses or attempt == max_retries:
+            break
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+    # NB: 404s are allowed through as "Page not found" evaluation pages are
+    # expected and dropped later
+    if req.status_code not in (200, 304, 404):
+        req.raise_for_status()
+
+    return set_cached(url, req.status_code, req.headers, req.text)
 
 # %%
 # GRAB PAGE URLS
 # NB: Non-zero based page indexing
 URL = "https://evaluation-registry.cabinetoffice.gov.uk/search/?page="
-headers = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"     # noqa: E501
-}
+RESULTS_SELECTOR = 'div[aria-label="Evaluation Registry search results"]'
 
-urlList = []
 
-next_page = True
-page = 1
+def canonicalise_url(
+    href: str
+) -> str:
+    """Canonicalise a URL so that links to the same page match"""
 
-print(datetime.datetime.now())
-while next_page:
+    parts = urlsplit(href)
 
-    req = session.get(URL + str(page), headers=headers)
-    soup = bs(req.text, "html.parser")
+    return urlunsplit((parts.scheme, parts.netloc, parts.path.rstrip("/") + "/", "", ""))
 
-    cards = soup.find("div", {"aria-label": "Evaluation Registry search results"})
-    card_urls = cards.find_all("a", {
-        "class": "govuk-link",
-    })
 
-    # Restrict to links starking with "/search/"
-    card_urls = [url for url in card_urls if re.match(r"^/search/", url["href"])]
+def get_last_page(
+    soup: bs
+) -> int:
+    """Grab the number of the last page of search results"""
+
+    page_links = soup.select("a.govuk-pagination__link")
+    page_numbers = [
+        int(link.text.strip()) for link in page_links if link.text.strip().isdigit()
+    ]
+
+    # NB: A single page of results has no pagination, but must still have results
+    if not page_numbers:
+        assert soup.select_one(RESULTS_SELECTOR) is not None, (
+            "First page has neither pagination nor search results"
+        )
+        assert soup.select_one("div.govuk-pagination__next") is None, (
+            "First page links to a next page but not to any numbered pages"
+        )
+        return 1
+
+    return max(page_numbers)
+
+
+def get_page_urls(
+    page: int,
+    last_page: int,
+    soup: bs
+) -> list[str]:
+    """Grab evaluation URLs from a page of search results"""
+
+    cards = soup.select_one(RESULTS_SELECTOR)
+    assert cards is not None, f"Page {page} has no search results"
+
+    # NB: Restricted to links starting with "/search/"
+    card_urls = cards.select('a.govuk-link[href^="/search/"]')
 
     page_urls = []
 
     # Extract URLs and titles from the card URLs
+    # NB: URLs are canonicalised so that links to the same evaluation are
+    # deduplicated before being requested
     for url in card_urls:
-        if "href" in url.attrs:
-            print(url.text.strip(), url.attrs["href"])
-            page_urls.append(url.attrs["href"])
-            urlList.append(url.attrs["href"])
+        print(url.text.strip(), url["href"])
+        page_urls.append(canonicalise_url(url["href"]))
 
     # Check that there are exactly 25 URLs per page (except possibly the last page)
-    has_next_page = soup.find("div", {"class": "govuk-pagination__next"}) is not None
+    has_next_page = soup.select_one("div.govuk-pagination__next") is not None
+
+    # Check that the last page found by get_last_page() is the last page
+    assert not (page == last_page and has_next_page), (
+        f"Page {page} was expected to be the last page but links to a next page"
+    )
 
     if has_next_page and len(page_urls) != 25:
         print(f"Warning: Page {page} has {len(page_urls)} URLs, expected 25")
@@ -82,46 +264,101 @@ while next_page:
 
     print(f"Page {page}: {len(page_urls)} URLs found")
 
-    if has_next_page:
-        next_page = True
-    else:
-        next_page = False
+    return page_urls
+
+
+async def get_page(
+    client: httpx.AsyncClient,
+    page: int,
+    last_page: int
+) -> list[str]:
+    """Grab evaluation URLs from a page of search results"""
+
+    text = await get_text(client, URL + str(page))
+
+    return get_page_urls(page, last_page, bs(text, "lxml"))
+
+
+async def get_all_pages(
+    client: httpx.AsyncClient,
+    last_page: int
+) -> list[list[str]]:
+    """Grab evaluation URLs from pages 2 onwards of search results concurrently"""
+
+    tasks = [get_page(client, page, last_page) for page in range(2, last_page + 1)]
+
+    return await asyncio.gather(*tasks)
+
+
+# %%
+print(datetime.datetime.now())
+
+# Grab the first page to find out how many pages there are
+soup = bs(run(cached(get_text(client, URL + "1"))), "lxml")
 
-    page += 1
+last_page = get_last_page(soup)
+# NB: URLs are collected in a set as duplicates are returned across pages
+urlSet = set(get_page_urls(1, last_page, soup))
+
+# Grab the remaining pages
+for page_urls in run(cached(get_all_pages(client, last_page))):
+    urlSet.update(page_urls)
 print(datetime.datetime.now())
 
-# Save URLs to pickle
-urlList = list(set(urlList))
-pd.DataFrame(urlList).to_pickle("urls_20250703.pkl")
+# Save URLs to parquet
+urlList = list(urlSet)
+pd.DataFrame(urlList, columns=["url"]).to_parquet(
+    f"urls_{date_tag}.parquet", engine="pyarrow", compression="zstd"
+)
 
 
 # %%
-def get_details(
+# XPaths for evaluation details
+# NB: Compiled once rather than on every call to get_details()
+title_xpath = etree.XPath("string(//h1[contains(@class, 'govuk-heading-l')])")
+description_xpath = etree.XPath(
+    "string(//p[@class='govuk-body govuk-grid-column-two-thirds govuk-!-padding-0'])"
+)
+rows_xpath = etree.XPath("//div[contains(@class, 'govuk-summary-list__row')]")
+key_xpath = etree.XPath("string(dt[contains(@class, 'govuk-summary-list__key')])")
+value_xpath = etree.XPath("string(dd[contains(@class, 'govuk-summary-list__value')])")
+
+
+async def get_details(
+    client: httpx.AsyncClient,
     partial: str
-) -> dict[str, str]:
-    """Grab evaluation details"""
+) -> dict[str, str] | None:
+    """Grab evaluation details, or None if the page has no evaluation details"""
 
     url = "https://evaluation-registry.cabinetoffice.gov.uk" + str(partial)
 
     details = {}
 
-    content = session.get(url, headers=headers)
-    soup = bs(content.text, "html.parser")
+    text = await get_text(client, url)
+    if not text.strip():
+        print("Empty page: " + url)
+        return None
+
+    tree = lh.fromstring(text)
 
     details["url"] = url
-    details["title"] = soup.find("h1", {"class": "govuk-heading-l"}).text.strip()
+    details["title"] = title_xpath(tree).strip()
     if details["title"] == "Page not found":
         print("Page not found: " + url)
         return details
 
-    details["description"] = soup.find(
-        "p", {"class": "govuk-body govuk-grid-column-two-thirds govuk-!-padding-0"}
-    ).text.strip()
+    # NB: Pages without a summary list aren't evaluation pages - e.g. error pages
+    # - so are skipped rather than saved with blank details
+    rows = rows_xpath(tree)
+    if not rows:
+        print("No evaluation details found: " + url)
+        return None
+
+    details["description"] = description_xpath(tree).strip()
 
-    rows = soup.find_all("div", {"class": "govuk-summary-list__row"})
     for row in rows:
-        key = row.find("dt", {"class": "govuk-summary-list__key"}).text.strip()
-        value = row.find("dd", {"class": "govuk-summary-list__value"}).text.strip()
+        key = key_xpath(row).strip()
+        value = value_xpath(row).strip()
 
         # Needed to handle keys that can appear multiple times as with Event Dates
         if key not in details:
@@ -132,14 +369,23 @@ def get_details(
     return details
 
 
+async def get_all_details(
+    client: httpx.AsyncClient,
+    partials: list[str]
+) -> list[dict[str, str]]:
+    """Grab evaluation details for all evaluations concurrently"""
+
+    tasks = [get_details(client, partial) for partial in partials]
+
+    return [
+        details for details in await asyncio.gather(*tasks) if details is not None
+    ]
+
+
 # %%
 # EXTRACT DETAILS
-details_list = []
-
 print(datetime.datetime.now())
-for partial in urlList:
-    details = get_details(partial)
-    details_list.append(details)
+details_list = run(cached(get_all_details(client, urlList)))
 print(datetime.datetime.now())
 
 df_details = pd.DataFrame(details_list)
@@ -147,8 +393,17 @@ df_details = pd.DataFrame(details_list)
 display(df_details)
 
 # %%
-# SAVE TO PICKLE
-df_details.to_pickle("evaluationdetails_20250703.pkl")
+# SAVE TO PARQUET
+# NB: Columns with a handful of repeated values are saved as categoricals so
+# that they are dictionary-encoded. Only columns that were scraped are
+# converted, so the snapshot is saved even if e.g. every page was not found
+df_details.astype({
+    c: "category"
+    for c in ("Lead department", "Other departments", "Evaluation stage")
+    if c in df_details
+}).to_parquet(
+    f"evaluationdetails_{date_tag}.parquet", engine="pyarrow", compression="zstd"
+)
 
 # %%
 # Drop "Page not found" rows
@@ -167,13 +422,21 @@ df_details = df_details.loc[
 # %%
 # EDIT DATA
 # Remove "Closed organisation: " from specified columns
-df_details["Lead department"] = df_details["Lead department"].str.replace(
-    "Closed organisation: ", "", regex=False
+# NB: "Other departments" can list several departments, any of which may be
+# closed, so there the text is removed wherever it appears
+df_details["Lead department"] = df_details["Lead department"].str.removeprefix(
+    "Closed organisation: "
 )
 df_details["Other departments"] = df_details["Other departments"].str.replace(
     "Closed organisation: ", "", regex=False
 )
 
+# %%
+# Convert department columns to categoricals
+# NB: These contain a small number of heavily repeated values
+for col in ["Lead department", "Other departments"]:
+    df_details[col] = df_details[col].astype("category")
+
 # %%
 # Clean "Evalueation types" column
 expected_evaluation_types = [
@@ -205,14 +468,27 @@ assert set(
 
 # %%
 # Convert "Evaluation types" to separate columns for each evaluation type
+# NB: Rows without evaluation types are left as NA rather than False
 pos = df_details.columns.get_loc("Evaluation types")
 
-i = 1
+evaluation_type_dummies = df_details["Evaluation types"].str.get_dummies(
+    sep=", "
+).reindex(
+    columns=expected_evaluation_types,
+    fill_value=0,
+).astype(bool).astype(object).mask(
+    df_details["Evaluation types"].isna(),
+    pd.NA,
+)
 
-for evaluation_type in expected_evaluation_types:
-    df_details.insert(pos + i, evaluation_type, None)
-    df_details[evaluation_type] = df_details["Evaluation types"].str.contains(evaluation_type)
-    i += 1
+df_details = pd.concat(
+    [
+        df_details.iloc[:, :pos + 1],
+        evaluation_type_dummies,
+        df_details.iloc[:, pos + 1:],
+    ],
+    axis=1,
+)
 
 # %%
 sorted(
@@ -256,20 +532,21 @@ df_dates = df_details[["Event Name split", "Event date split"]].explode(
 
 # %%
 # Convert to datetime to allow sorting
-df_dates["Event date split"] = df_dates["Event date split"].apply(
-    lambda x: pd.to_datetime(x, errors="coerce", format="%B %Y")
+df_dates["Event date split"] = pd.to_datetime(
+    df_dates["Event date split"], errors="coerce", format="%B %Y"
 )
 
 # %%
-# Drop duplicates, preserving oldest date
-# NB: reset_index() in order to include the index in drop_duplicates()
-df_dates = df_dates.reset_index().sort_values(
-    ["index", "Event date split"],
-).drop_duplicates(
-    ["index", "Event Name split"],
-    keep="last",
-)
-df_dates.set_index("index", inplace=True)
+# Drop duplicates, preserving latest date
+# NB: groupby() on the index as well as the event name, to keep one row per
+# evaluation and event
+df_dates = df_dates.loc[
+    df_dates["Event Name split"].notna()
+]
+df_dates = df_dates.groupby(
+    [df_dates.index, "Event Name split"],
+    sort=False,
+)["Event date split"].max().reset_index(level=1)
 
 # %%
 # Format date
@@ -277,9 +554,7 @@ df_dates["Event date split"] = df_dates["Event date split"].dt.strftime("%Y-%m")
 
 # %%
 # Pivot
-df_dates_pivot = df_dates.loc[
-    df_dates["Event Name split"].notna()
-].pivot(
+df_dates_pivot = df_dates.pivot(
     columns="Event Name split",
     values="Event date split"
 )
@@ -297,6 +572,11 @@ df_dates_pivot.columns = [
     "Event - " + c for c in df_dates_pivot.columns.tolist()
 ]
 
+# %%
+# Convert date columns to categoricals
+# NB: These contain a small number of heavily repeated "%Y-%m" values
+df_dates_pivot = df_dates_pivot.astype("category")
+
 # %%
 # Join df_dates_pivot back to df_details
 df_details = df_details.join(
@@ -305,41 +585,38 @@ df_details = df_details.join(
 
 # %%
 # Flag rows where there is a repeated "Event Name split" in df_details
-df_details.insert(
-    df_details.columns.get_loc("Event date") + 1,
-    "Event Name duplicated",
-    False,
-)
-df_details.loc[
-    df_details["Event Name split"].apply(
-        lambda x: len(x) if isinstance(x, list) else 0
-    ) != df_details["Event Name split"].apply(
-        lambda x: len(set(x)) if isinstance(x, list) else 0
-    ),
-    "Event Name duplicated"
-] = True
+# NB: Compares the number of event names to the number of unique event names
+df_details["Event Name duplicated"] = df_details[
+    "Event Name split"
+].str.len().fillna(0) != df_details[
+    "Event Name split"
+].explode().groupby(level=0).nunique()
 
 # %%
-# Move date columns to the right of "Event Name duplicated" column
+# Move "Event Name duplicated" and date columns to the right of "Event date" column,
+# dropping "Event Name split" and "Event date split" columns
+# NB: Done in a single reindex to avoid copying df_details for each step
 expected_event_names = [
     "Event - " + c for c in expected_event_names
 ]
-df_details = df_details[
-    df_details.columns[:df_details.columns.get_loc("Event Name duplicated") + 1].tolist()
-    + expected_event_names + [
-        c for c in df_details.columns[
-            df_details.columns.get_loc("Event Name duplicated") + 1:
-        ].tolist() if c not in expected_event_names
-    ]
+event_columns = ["Event Name duplicated"] + expected_event_names
+
+columns = [
+    c for c in df_details.columns
+    if c not in event_columns + ["Event Name split", "Event date split"]
 ]
+pos = columns.index("Event date")
 
-# %%
-# Drop "Event Name split" and "Event date split" columns
-df_details.drop(
-    ["Event Name split", "Event date split"],
-    axis=1,
-    inplace=True,
+df_details = df_details.reindex(
+    columns=columns[:pos + 1] + event_columns + columns[pos + 1:]
 )
 
 # %%
 df_details
+
+# %%
+# CLOSE CONNECTIONS
+run(client.aclose())
+loop.call_soon_threadsafe(loop.stop)
+loop_thread.join()
+loop.close()